@@ -2,19 +2,57 @@
 OCR Service using Tesseract (FREE, local OCR).
 """
 
+import functools
+import hashlib
+import logging
 import os
-from typing import Optional
+import queue
+import re
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+import cv2
 import numpy as np
 from PIL import Image
 import io
 
+logger = logging.getLogger(__name__)
+
 # Tesseract OCR import
 try:
     import pytesseract
     TESSERACT_AVAILABLE = True
 except ImportError:
     TESSERACT_AVAILABLE = False
-    print("Warning: pytesseract not installed. Run: pip install pytesseract")
+
+# Optional in-process Tesseract API (keeps language models loaded)
+try:
+    from tesserocr import (
+        PyTessBaseAPI, PSM, RIL, get_languages, iterate_level, tesseract_version
+    )
+    TESSEROCR_AVAILABLE = True
+except ImportError:
+    TESSEROCR_AVAILABLE = False
+
+# Whitespace runs collapsed when cleaning OCR lines
+_WS = re.compile(r'\s+')
+
+
+@functools.lru_cache(maxsize=32)
+def _parse_config(config: str) -> Tuple[int, Tuple[Tuple[str, str], ...]]:
+    """Split a Tesseract CLI config into its PSM and `-c name=value` variables."""
+    tokens = config.split()
+    psm = 7
+    variables = []
+    for i, token in enumerate(tokens[:-1]):
+        if token == '--psm':
+            psm = int(tokens[i + 1])
+        elif token == '-c' and '=' in tokens[i + 1]:
+            variables.append(tuple(tokens[i + 1].split('=', 1)))
+    return psm, tuple(variables)
 
 
 class OCRService:
@@ -23,6 +61,19 @@ class OCRService:
     No API keys or credentials required.
     """
     
+    # Single line of text: zone values are one line each
+    ROI_CONFIG = '--psm 7'
+    
+    # Tesseract already runs up to 4 internal threads per page
+    MAX_ROI_WORKERS = 4
+    
+    # Maximum number of ROI results kept in memory
+    CACHE_SIZE = 256
+    
+    # Shared by all instances so zones never create their own pool
+    _executor = None
+    _executor_lock = threading.Lock()
+    
     def __init__(self, tesseract_path: Optional[str] = None):
         """
         Initialize OCR service.
@@ -32,10 +83,143 @@ class OCRService:
                            On Windows: "C:\\Program Files\\Tesseract-OCR\\tesseract.exe"
                            On Linux/Mac: usually just "tesseract" or leave None
         """
-        if tesseract_path:
+        if tesseract_path and TESSERACT_AVAILABLE:
             pytesseract.pytesseract.tesseract_cmd = tesseract_path
         
-        self.is_configured = TESSERACT_AVAILABLE
+        # In-process handles: a bounded pool per page segmentation mode,
+        # checked out for each call since a PyTessBaseAPI must not be used
+        # by two threads at once. Handles load lazily and are reused by
+        # whichever thread needs one, so models are loaded at most
+        # MAX_ROI_WORKERS times per mode for the life of the service. Line
+        # (PSM 7) and block (PSM 6) pools are kept apart so full-page OCR
+        # never reconfigures a zone handle.
+        self._pools = {}
+        self._pool_sizes = {}
+        self._apis_lock = threading.Lock()
+        self._use_tesserocr = False
+        if TESSEROCR_AVAILABLE:
+            # Check the language data without keeping an engine resident
+            try:
+                _, languages = get_languages()
+            except RuntimeError as e:
+                logger.warning("tesserocr init failed, using pytesseract: %s", e)
+            else:
+                if {'pol', 'eng'} <= set(languages):
+                    self._use_tesserocr = True
+                else:
+                    logger.warning("tesserocr lacks pol+eng data, using pytesseract")
+        
+        # Checked once here; extraction methods then just return "" quietly
+        self.is_configured = TESSERACT_AVAILABLE or self._use_tesserocr
+        if not self.is_configured:
+            logger.warning("Tesseract not available. Install with: pip install pytesseract")
+        
+        # LRU cache of ROI results keyed by SHA-256 of the pixels
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+    
+    @contextmanager
+    def _checkout_api(self, psm: int):
+        """
+        Borrow a tesserocr handle for the given page segmentation mode.
+        
+        Yields None once tesserocr is off (closed, or a handle failed to
+        load); callers then fall back to pytesseract.
+        """
+        api = None
+        with self._apis_lock:
+            pool = self._pools.get(psm)
+            if pool is None:
+                pool = self._pools[psm] = queue.LifoQueue()
+                self._pool_sizes[psm] = 0
+            
+            create = pool.empty() and self._pool_sizes[psm] < self.MAX_ROI_WORKERS
+            if create:
+                self._pool_sizes[psm] += 1
+            enabled = self._use_tesserocr
+        
+        if not enabled:
+            pass
+        elif create:
+            try:
+                api = PyTessBaseAPI(lang='pol+eng', psm=psm)
+            except Exception as e:
+                # Don't retry the model load on every call
+                logger.warning("tesserocr init failed, using pytesseract: %s", e)
+                with self._apis_lock:
+                    self._pool_sizes[psm] -= 1
+                self.close()
+        else:
+            api = self._wait_for_api(pool)
+        
+        if api is None:
+            yield None
+            return
+        
+        try:
+            yield api
+        finally:
+            pool.put(api)
+            if not self._use_tesserocr:
+                # Closed while this handle was in use
+                self._drain(pool)
+    
+    def _wait_for_api(self, pool: queue.LifoQueue):
+        """Wait for another caller to hand a handle back; None once closed."""
+        while True:
+            try:
+                return pool.get(timeout=0.5)
+            except queue.Empty:
+                if not self._use_tesserocr:
+                    return None
+    
+    @staticmethod
+    def _drain(pool: queue.LifoQueue):
+        """End every idle handle in a pool."""
+        while True:
+            try:
+                api = pool.get_nowait()
+            except queue.Empty:
+                return
+            api.End()
+    
+    def close(self):
+        """
+        Release all tesserocr handles and stop using tesserocr.
+        
+        Idle handles are ended right away; handles checked out by another
+        thread are ended when that call hands them back. Later calls use
+        pytesseract if it is installed.
+        """
+        with self._apis_lock:
+            self._use_tesserocr = False
+            self.is_configured = TESSERACT_AVAILABLE
+            pools = list(self._pools.values())
+        
+        for pool in pools:
+            self._drain(pool)
+    
+    def __del__(self):
+        # Guard against a partially constructed instance
+        if getattr(self, '_pools', None):
+            self.close()
+    
+    @classmethod
+    def _get_executor(cls) -> ThreadPoolExecutor:
+        """Return the shared thread pool used for per-zone OCR."""
+        if cls._executor is None:
+            with cls._executor_lock:
+                if cls._executor is None:
+                    cls._executor = ThreadPoolExecutor(
+                        max_workers=cls.MAX_ROI_WORKERS,
+                        thread_name_prefix='ocr_roi'
+                    )
+        return cls._executor
+    
+    @staticmethod
+    def _clean_line(text: str) -> str:
+        """Collapse whitespace and uppercase a single-line OCR result."""
+        return _WS.sub(' ', text.strip()).upper()
     
     def extract_text(self, image: bytes) -> str:
         """
@@ -47,14 +231,19 @@ class OCRService:
         Returns:
             Extracted text string.
         """
-        if not TESSERACT_AVAILABLE:
-            print("Warning: Tesseract not available. Install with: pip install pytesseract")
+        if not self.is_configured:
             return ""
         
         try:
             # Convert bytes to PIL Image
             pil_image = Image.open(io.BytesIO(image))
             
+            if self._use_tesserocr:
+                with self._checkout_api(PSM.SINGLE_BLOCK) as api:
+                    if api is not None:
+                        api.SetImage(pil_image)
+                        return api.GetUTF8Text().strip()
+            
             # Extract text using Tesseract
             text = pytesseract.image_to_string(
                 pil_image,
@@ -65,7 +254,7 @@ class OCRService:
             return text.strip()
             
         except Exception as e:
-            print(f"Tesseract OCR Error: {e}")
+            logger.warning("Tesseract OCR Error: %s", e)
             return ""
     
     def extract_text_from_image(self, image_array: np.ndarray) -> str:
@@ -78,20 +267,25 @@ class OCRService:
         Returns:
             Extracted text string.
         """
-        if not TESSERACT_AVAILABLE:
-            print("Warning: Tesseract not available")
+        if not self.is_configured:
             return ""
         
         try:
-            # Convert BGR to RGB
+            # Convert BGR to RGB (contiguous buffer, unlike a ::-1 view)
             if len(image_array.shape) == 3:
-                rgb_image = image_array[..., ::-1]  # BGR to RGB
+                rgb_image = cv2.cvtColor(image_array, cv2.COLOR_BGR2RGB)
             else:
                 rgb_image = image_array
             
             # Convert to PIL Image
             pil_image = Image.fromarray(rgb_image)
             
+            if self._use_tesserocr:
+                with self._checkout_api(PSM.SINGLE_BLOCK) as api:
+                    if api is not None:
+                        api.SetImage(pil_image)
+                        return api.GetUTF8Text().strip()
+            
             # Extract text
             text = pytesseract.image_to_string(
                 pil_image,
@@ -102,49 +296,293 @@ class OCRService:
             return text.strip()
             
         except Exception as e:
-            print(f"Tesseract OCR Error: {e}")
+            logger.warning("Tesseract OCR Error: %s", e)
             return ""
     
-    def extract_text_from_roi(self, image_array: np.ndarray) -> str:
+    def _cache_key(self, image_array: np.ndarray, config: str,
+                   binarized: bool = False) -> bytes:
+        """Build the ROI cache key from the pixel data, Tesseract config and binarized flag."""
+        digest = hashlib.sha256(image_array.tobytes())
+        digest.update(f'{image_array.shape}{image_array.dtype}{config}{binarized}'.encode())
+        return digest.digest()
+    
+    def _cache_get(self, key: bytes) -> Optional[str]:
+        """Look up a cached ROI result, marking it as recently used."""
+        with self._cache_lock:
+            text = self._cache.get(key)
+            if text is not None:
+                self._cache.move_to_end(key)
+            return text
+    
+    def _cache_put(self, key: bytes, text: str):
+        """Store a ROI result, evicting the least recently used entry."""
+        with self._cache_lock:
+            self._cache[key] = text
+            self._cache.move_to_end(key)
+            if len(self._cache) > self.CACHE_SIZE:
+                self._cache.popitem(last=False)
+    
+    @staticmethod
+    def binarize(image_array: np.ndarray) -> np.ndarray:
+        """Convert a BGR(A) or grayscale image to black-and-white (Otsu threshold)."""
+        channels = image_array.shape[2] if image_array.ndim == 3 else 1
+        if channels >= 3:
+            # BGR2GRAY accepts 3- and 4-channel input
+            gray = cv2.cvtColor(image_array, cv2.COLOR_BGR2GRAY)
+        elif image_array.ndim == 3:
+            # Grayscale with a trailing channel axis, e.g. (h, w, 1)
+            gray = image_array[..., 0]
+        else:
+            gray = image_array
+        
+        _, bw = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+        return bw
+    
+    def _recognize_roi(self, image_array: np.ndarray, config: str,
+                       binarized: bool = False) -> str:
+        """Run single-line OCR on one ROI, without caching or error handling."""
+        # Binarized single-channel input lets Tesseract skip its own thresholding
+        bw = image_array if binarized else self.binarize(image_array)
+        
+        if self._use_tesserocr:
+            # Hand the raw 8-bit buffer over directly, no PIL conversion
+            bw = np.ascontiguousarray(bw)
+            height, width = bw.shape
+            # The line handle serves every ROI config; switching PSM and
+            # variables is cheap, unlike loading another handle's models
+            psm, variables = _parse_config(config)
+            with self._checkout_api(PSM.SINGLE_LINE) as api:
+                if api is not None:
+                    api.SetPageSegMode(psm)
+                    api.SetVariable('tessedit_char_whitelist', '')
+                    for name, value in variables:
+                        api.SetVariable(name, value)
+                    api.SetImageBytes(bw.tobytes(), width, height, 1, width)
+                    return self._clean_line(api.GetUTF8Text())
+        
+        return self._recognize_batch([image_array], config, binarized)[0]
+    
+    def _recognize_batch(self, rois: List[np.ndarray], config: str,
+                         binarized: bool = False) -> List[str]:
+        """Run single-line OCR on several ROIs in one Tesseract process."""
+        with tempfile.TemporaryDirectory(prefix='idcard_ocr_') as tmp_dir:
+            # Images are written with OpenCV and passed by path, so
+            # pytesseract never round-trips them through PIL. PGM has no
+            # compression pass, unlike PNG's zlib.
+            paths = []
+            for i, roi in enumerate(rois):
+                path = os.path.join(tmp_dir, f'roi_{i:02d}.pgm')
+                cv2.imwrite(path, roi if binarized else self.binarize(roi))
+                paths.append(path)
+            
+            if len(paths) == 1:
+                input_path = paths[0]
+            else:
+                input_path = os.path.join(tmp_dir, 'list_of_images.txt')
+                with open(input_path, 'w', encoding='utf-8') as f:
+                    f.write('\n'.join(paths) + '\n')
+            
+            # One process for all zones, single line mode per page
+            text = pytesseract.image_to_string(
+                input_path,
+                lang='pol+eng',
+                config=config
+            )
+        
+        pages = text.split('\x0c')
+        if len(pages) < len(rois):
+            pages += [""] * (len(rois) - len(pages))
+        
+        return [self._clean_line(page) for page in pages[:len(rois)]]
+    
+    def extract_text_from_roi(self, image_array: np.ndarray,
+                              config: str = ROI_CONFIG,
+                              binarized: bool = False) -> str:
         """
         Extract text from Region of Interest (ROI) - optimized for small crops.
         
+        Results are cached by a hash of the ROI pixels, so repeated crops
+        (retries, re-uploads) skip Tesseract entirely.
+        
         Args:
             image_array: Cropped image (ROI).
+            config: Tesseract config, e.g. a PSM and character whitelist.
+            binarized: ROI is already black-and-white (see binarize()).
             
         Returns:
             Cleaned extracted text.
         """
-        if not TESSERACT_AVAILABLE:
+        if not self.is_configured:
             return ""
         
+        key = self._cache_key(image_array, config, binarized)
+        cached = self._cache_get(key)
+        if cached is not None:
+            return cached
+        
         try:
-            # Ensure image is RGB
-            if len(image_array.shape) == 3:
-                rgb_image = image_array[..., ::-1]
-            else:
-                rgb_image = image_array
+            text = self._recognize_roi(image_array, config, binarized)
+        except Exception as e:
+            logger.warning("Tesseract ROI OCR Error: %s", e)
+            return ""
+        
+        self._cache_put(key, text)
+        return text
+    
+    def extract_text_from_rois(self, rois: List[np.ndarray],
+                               configs: Optional[List[Optional[str]]] = None,
+                               binarized: bool = False) -> List[str]:
+        """
+        Extract text from several ROIs at once.
+        
+        Cached ROIs are answered directly. With tesserocr the remaining ROIs
+        are recognized in parallel on the shared thread pool. With
+        pytesseract each ROI is written to a temporary directory and the
+        image paths are listed in a text file, which one Tesseract process
+        per distinct config reads as a multi-page input; pages are
+        separated by a form feed in the output.
+        
+        Args:
+            rois: Cropped images (ROIs), in the order results are wanted.
+            configs: Tesseract config per ROI; None entries use ROI_CONFIG.
+                     With pytesseract every distinct config costs one
+                     process, so keep the set small.
+            binarized: ROIs are already black-and-white (see binarize()).
             
-            pil_image = Image.fromarray(rgb_image)
+        Returns:
+            Cleaned extracted text for each ROI, in input order.
+        """
+        texts = [""] * len(rois)
+        if not self.is_configured or not rois:
+            return texts
+        
+        if configs is None:
+            configs = [None] * len(rois)
+        configs = [config or self.ROI_CONFIG for config in configs]
+        
+        keys = [self._cache_key(roi, config, binarized) for roi, config in zip(rois, configs)]
+        misses = []
+        for i, key in enumerate(keys):
+            cached = self._cache_get(key)
+            if cached is None:
+                misses.append(i)
+            else:
+                texts[i] = cached
+        
+        if not misses:
+            return texts
+        
+        # In-process API has no spawn cost to amortize, so run the zones in
+        # parallel instead; Tesseract releases the GIL while recognizing
+        if self._use_tesserocr:
+            executor = self._get_executor()
+            futures = {
+                executor.submit(self._recognize_roi, rois[i], configs[i], binarized): i
+                for i in misses
+            }
+            for future in as_completed(futures):
+                i = futures[future]
+                try:
+                    texts[i] = future.result()
+                except Exception as e:
+                    logger.warning("Tesseract ROI OCR Error: %s", e)
+                    continue
+                self._cache_put(keys[i], texts[i])
+            return texts
+        
+        # Tesseract takes one config per process, so batch by config
+        groups = {}
+        for i in misses:
+            groups.setdefault(configs[i], []).append(i)
+        
+        for config, indices in groups.items():
+            try:
+                batch = self._recognize_batch([rois[i] for i in indices], config, binarized)
+            except Exception as e:
+                logger.warning("Tesseract batch OCR Error: %s", e)
+                continue
             
-            # Use PSM 7 for single line text (better for field values)
-            # Use PSM 8 for single word (for short fields)
-            text = pytesseract.image_to_string(
-                pil_image,
-                lang='pol+eng',
-                config='--psm 7'  # Single line of text
-            )
+            for i, text in zip(indices, batch):
+                texts[i] = text
+                self._cache_put(keys[i], text)
+        return texts
+    
+    def extract_text_from_zones(self, image_array: np.ndarray,
+                                zones: Dict[str, Tuple[int, int, int, int]]) -> Dict[str, str]:
+        """
+        Extract text for several zones from a single full-page OCR pass.
+        
+        The whole image is recognized once as a uniform block (PSM 6) and
+        every word is assigned to the zone containing the centre of its
+        bounding box. Words keep Tesseract's reading order.
+        
+        Args:
+            image_array: OpenCV image (BGR or grayscale) of the whole document.
+            zones: Absolute (x, y, width, height) rectangle for each field.
             
-            # Clean up the text
-            cleaned = text.strip()
-            # Remove extra whitespace
-            cleaned = ' '.join(cleaned.split())
+        Returns:
+            Cleaned extracted text for each zone.
+        """
+        texts = {field: "" for field in zones}
+        if not self.is_configured or not zones:
+            return texts
+        
+        try:
+            # Collect (word, x1, y1, x2, y2) for every recognized word
+            words = None
+            if self._use_tesserocr:
+                if len(image_array.shape) == 3:
+                    rgb_image = cv2.cvtColor(image_array, cv2.COLOR_BGR2RGB)
+                else:
+                    rgb_image = image_array
+                
+                pil_image = Image.fromarray(rgb_image)
+                with self._checkout_api(PSM.SINGLE_BLOCK) as api:
+                    if api is not None:
+                        api.SetImage(pil_image)
+                        api.Recognize()
+                        words = []
+                        for word in iterate_level(api.GetIterator(), RIL.WORD):
+                            box = word.BoundingBox(RIL.WORD)
+                            if box:
+                                words.append((word.GetUTF8Text(RIL.WORD), *box))
             
-            return cleaned.upper()  # Convert to uppercase
+            if words is None:
+                words = []
+                # Uncompressed PPM/PGM written by OpenCV, passed by path
+                ext = '.ppm' if len(image_array.shape) == 3 else '.pgm'
+                with tempfile.TemporaryDirectory(prefix='idcard_ocr_') as tmp_dir:
+                    path = os.path.join(tmp_dir, 'page' + ext)
+                    cv2.imwrite(path, image_array)
+                    data = pytesseract.image_to_data(
+                        path,
+                        lang='pol+eng',
+                        config='--psm 6',
+                        output_type=pytesseract.Output.DICT
+                    )
+                for i, word in enumerate(data['text']):
+                    left, top = data['left'][i], data['top'][i]
+                    words.append((word, left, top,
+                                  left + data['width'][i], top + data['height'][i]))
             
         except Exception as e:
-            print(f"Tesseract ROI OCR Error: {e}")
-            return ""
+            logger.warning("Tesseract OCR Error: %s", e)
+            return texts
+        
+        zone_words = {field: [] for field in zones}
+        for word, x1, y1, x2, y2 in words:
+            if not word or not word.strip():
+                continue
+            
+            cx = (x1 + x2) / 2
+            cy = (y1 + y2) / 2
+            for field, (x, y, w, h) in zones.items():
+                if x <= cx < x + w and y <= cy < y + h:
+                    zone_words[field].append(word)
+                    break
+        
+        return {field: self._clean_line(' '.join(parts))
+                for field, parts in zone_words.items()}
     
     def is_available(self) -> bool:
         """
@@ -153,7 +591,7 @@ class OCRService:
         Returns:
             True if Tesseract is installed and configured.
         """
-        return TESSERACT_AVAILABLE
+        return self.is_configured
     
     def verify_installation(self) -> dict:
         """
@@ -162,6 +600,13 @@ class OCRService:
         Returns:
             Dictionary with installation status and version.
         """
+        if self._use_tesserocr:
+            return {
+                'installed': True,
+                'version': tesseract_version().splitlines()[0],
+                'status': 'Ready (in-process)'
+            }
+        
         if not TESSERACT_AVAILABLE:
             return {
                 'installed': False,
@@ -3,7 +3,8 @@ Main OCR processing pipeline for ID card scanning.
 Uses Tesseract OCR - FREE, no API keys needed!
 """
 
-from typing import Dict, Any, Tuple, Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Tuple, Optional
 import numpy as np
 
 from ocr.read_zones import ZoneReader
@@ -13,6 +14,16 @@ from ocr.perspective import PerspectiveCorrector
 from ocr.validators import ResultValidator
 from ocr.ocr_service import OCRService
 
+# Whitelisted configs for constrained fields. Kept to two so the
+# pytesseract fallback runs at most three batches per side.
+_NUMERIC_CONFIG = '--psm 7 -c tessedit_char_whitelist=0123456789.'
+_CODE_CONFIG = '--psm 7 -c tessedit_char_whitelist=0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ<'
+
+# {field: (x, y, width, height)} in target-size pixels
+ZoneRects = Dict[str, Tuple[int, int, int, int]]
+# (rows, cols) slice pair per zone, for zero-copy indexing of the card image
+ZoneSlices = Tuple[Tuple[slice, slice], ...]
+
 
 class IDCardOCRProcessor:
     """
@@ -32,11 +43,30 @@ class IDCardOCRProcessor:
         'b_miejsce_urodzenia', 'MRZ'
     ]
     
+    # Tesseract configs for fields with a constrained character set; a
+    # whitelist prunes the recognizer search. Other fields use '--psm 7'.
+    FIELD_CONFIGS = {
+        'f_data_urodzenia': _NUMERIC_CONFIG,
+        'f_plec': _CODE_CONFIG,
+        'f_numer_ID': _CODE_CONFIG,
+        'f_data_waznosci': _NUMERIC_CONFIG,
+        'f_numer_kodu': _NUMERIC_CONFIG,
+        'b_seria_id': _CODE_CONFIG,
+        'b_numer_id': _CODE_CONFIG,
+        'b_numer_ident': _NUMERIC_CONFIG,
+        'b_data_wydania': _NUMERIC_CONFIG,
+        'MRZ': _CODE_CONFIG,
+    }
+    
+    # Zones with a smaller fraction of black (ink) pixels are treated as blank
+    MIN_INK_RATIO = 0.005
+    
     def __init__(self, 
                  zones_dir: str = None,
                  tesseract_path: str = None,
                  target_width: int = 1000,
-                 target_height: int = 630):
+                 target_height: int = 630,
+                 full_page_ocr: bool = False):
         """
         Initialize IDCardOCRProcessor.
         
@@ -45,6 +75,9 @@ class IDCardOCRProcessor:
             tesseract_path: Optional path to tesseract executable.
             target_width: Target document width after normalization.
             target_height: Target document height after normalization.
+            full_page_ocr: Recognize each side with one full-page Tesseract
+                           pass and assign words to zones by their bounding
+                           boxes, instead of OCR on every cropped zone.
         """
         self.zone_reader = ZoneReader(zones_dir)
         self.detector = DocumentDetector(target_width, target_height)
@@ -55,6 +88,14 @@ class IDCardOCRProcessor:
         
         self.target_width = target_width
         self.target_height = target_height
+        self.full_page_ocr = full_page_ocr
+        
+        # Absolute zone rectangles per (side, fields, width, height). Both
+        # sides are loaded up front so requests never read or parse the
+        # zone JSON.
+        self._zone_rects = {}
+        self._get_absolute_zones('front', self.FRONT_FIELDS)
+        self._get_absolute_zones('back', self.BACK_FIELDS)
     
     def check_ocr_status(self) -> dict:
         """
@@ -114,44 +155,111 @@ class IDCardOCRProcessor:
             # Use original image if detection failed
             corrected = self.normalizer.normalize_document(image)
         
-        # Get zone definitions
-        zones_data = self.zone_reader.load_zones(side)
-        zones = zones_data['zones']
-        
-        # Extract text from each zone
-        results = {}
-        for field in fields:
-            if field not in zones:
-                results[field] = ""
-                continue
-            
-            zone = zones[field]
+        # Get absolute zone coordinates for the requested fields
+        names, rects, slices = self._get_absolute_zones(side, fields)
+        
+        # The only colour conversion for this side: one grayscale + Otsu
+        # pass over the whole card, shared by both OCR modes. Otsu also
+        # gets the full page histogram instead of each small zone's.
+        bw_full = self.ocr_service.binarize(corrected)
+        
+        if self.full_page_ocr:
+            # One Tesseract pass over the whole card, words mapped to zones
+            texts = self.ocr_service.extract_text_from_zones(bw_full, rects)
+        else:
+            texts = self._extract_zones(bw_full, names, slices)
+        
+        # Clean and validate
+        results = {
+            field: self.validator.clean_text(texts[field]) if texts.get(field) else ""
+            for field in fields
+        }
+        
+        # Validate specific fields
+        results = self.validator.validate_all(results)
+        
+        return results
+    
+    def _get_absolute_zones(self, side: str,
+                            fields: List[str]) -> Tuple[Tuple[str, ...], ZoneRects, ZoneSlices]:
+        """
+        Get absolute zone rectangles for one side, computed once and reused.
+        
+        Both the {field: (x, y, width, height)} mapping used by full-page
+        OCR and the (rows, cols) slices parallel to the field names are
+        cached, so neither OCR mode rebuilds them per request.
+        
+        Args:
+            side: 'front' or 'back'.
+            fields: Field names to extract, in result order.
             
-            # Calculate absolute coordinates
-            x = int(zone['x'] * self.target_width)
-            y = int(zone['y'] * self.target_height)
-            w = int(zone['width'] * self.target_width)
-            h = int(zone['height'] * self.target_height)
+        Returns:
+            Tuple of (field names with a zone, {field: (x, y, width, height)},
+            (rows, cols) slice pairs for indexing the image).
+        """
+        key = (side, tuple(fields), self.target_width, self.target_height)
+        cached = self._zone_rects.get(key)
+        if cached is not None:
+            return cached
+        
+        # Get zone definitions
+        zones = self.zone_reader.load_zones(side)['zones']
+        names = tuple(field for field in fields if field in zones)
+        
+        # Calculate absolute coordinates
+        rects = {
+            field: (
+                int(zones[field]['x'] * self.target_width),
+                int(zones[field]['y'] * self.target_height),
+                int(zones[field]['width'] * self.target_width),
+                int(zones[field]['height'] * self.target_height)
+            )
+            for field in names
+        }
+        
+        slices = tuple(
+            (slice(y, y + h), slice(x, x + w))
+            for x, y, w, h in rects.values()
+        )
+        
+        self._zone_rects[key] = (names, rects, slices)
+        return names, rects, slices
+    
+    def _extract_zones(self, bw_full: np.ndarray, names: Tuple[str, ...],
+                       slices: ZoneSlices) -> Dict[str, str]:
+        """
+        OCR every zone of the binarized card in a single call.
+        
+        Args:
+            bw_full: Binarized perspective-corrected document image.
+            names: Field names, parallel to slices.
+            slices: Precomputed (rows, cols) slices of each zone.
             
-            # Crop zone
-            cropped = self.detector.crop_zone(corrected, x, y, w, h)
+        Returns:
+            Raw OCR text for each field whose zone contains ink.
+        """
+        batch_fields = []
+        batch_rois = []
+        for field, zone_slice in zip(names, slices):
+            # Zones are views into the binarized card, no copies
+            roi = bw_full[zone_slice]
             
-            if cropped.size == 0:
-                results[field] = ""
+            if roi.size == 0:
                 continue
             
-            # OCR on cropped zone using ROI-optimized method
-            text = self.ocr_service.extract_text_from_roi(cropped)
-            
-            # Clean and validate
-            text = self.validator.clean_text(text)
+            # Skip OCR for blank zones (black text on white background)
+            ink_ratio = (roi.size - np.count_nonzero(roi)) / roi.size
+            if ink_ratio < self.MIN_INK_RATIO:
+                continue
             
-            results[field] = text
+            batch_fields.append(field)
+            batch_rois.append(roi)
         
-        # Validate specific fields
-        results = self.validator.validate_all(results)
+        # OCR on all zones using the ROI-optimized batch method
+        configs = [self.FIELD_CONFIGS.get(field) for field in batch_fields]
+        texts = self.ocr_service.extract_text_from_rois(batch_rois, configs, binarized=True)
         
-        return results
+        return dict(zip(batch_fields, texts))
     
     def process_both(self, front_base64: str, back_base64: str) -> Dict[str, Any]:
         """
@@ -164,8 +272,13 @@ class IDCardOCRProcessor:
         Returns:
             Dictionary with all extracted fields and success status.
         """
-        front_results = self.process_front(front_base64)
-        back_results = self.process_back(back_base64)
+        # Sides are independent; OCR runs outside the GIL. Zone OCR of both
+        # sides shares OCRService's pool, which caps the total thread count.
+        with ThreadPoolExecutor(max_workers=2, thread_name_prefix='ocr_side') as executor:
+            front_future = executor.submit(self.process_front, front_base64)
+            back_future = executor.submit(self.process_back, back_base64)
+            front_results = front_future.result()
+            back_results = back_future.result()
         
         # Combine all results
         all_results = {}